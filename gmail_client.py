@@ -1,21 +1,63 @@
 # gmail_client.py
 import os
 import json
-from typing import List, Dict, Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional
 
+import httplib2
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
-# Ajuste seus scopes aqui (tem que bater com o token.json)
-SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+from state_store import now_ts, touch_item
 
+# Ajuste seus scopes aqui (tem que bater com o token.json); GMAIL_SCOPES aceita lista separada por vírgula.
+# Lemos os headers From/Subject/Date e o snippet (usado no resumo e no pré-filtro).
+# O snippet vem do corpo da mensagem, então mantenha gmail.readonly: com o escopo
+# gmail.metadata o Gmail pode não devolver o snippet e o resumo fica só com o assunto.
+SCOPES = [
+    s.strip()
+    for s in os.getenv("GMAIL_SCOPES", "https://www.googleapis.com/auth/gmail.readonly").split(",")
+    if s.strip()
+]
 
-def _load_credentials_from_env() -> Credentials:
+# Único formato usado: compatível com o scope gmail.metadata (que proíbe "full"/"raw" e q=)
+MESSAGE_FORMAT = "metadata"
+
+# Só precisamos desses headers; o Gmail aceita até 100 sub-requests por batch
+METADATA_HEADERS = ["From", "Subject", "Date"]
+BATCH_SIZE = 100
+
+# Partial response: só os campos que usamos (menos bytes e parse mais rápido)
+GET_FIELDS = "id,threadId,snippet,payload/headers"
+
+# Fallback quando o batch não está disponível: GETs em paralelo
+FETCH_WORKERS = int(os.getenv("GMAIL_FETCH_WORKERS", "16"))
+
+_token_info = None
+_creds = None
+_service = None
+_executor = None
+_thread_local = threading.local()
+_refresh_lock = threading.Lock()
+
+# Renova o access token um pouco antes de expirar (~55 min de uso por token)
+REFRESH_MARGIN = timedelta(seconds=int(os.getenv("GMAIL_REFRESH_MARGIN_S", "300")))
+
+
+def _load_token_info() -> Dict[str, Any]:
     """
-    Carrega credenciais a partir da variável de ambiente GMAIL_TOKEN_JSON
-    (conteúdo inteiro do token.json).
+    Lê e faz o parse de GMAIL_TOKEN_JSON (conteúdo inteiro do token.json)
+    uma única vez por processo — o conteúdo não muda enquanto o worker roda.
     """
+    global _token_info
+    if _token_info is not None:
+        return _token_info
+
     token_json = os.environ.get("GMAIL_TOKEN_JSON")
     if not token_json:
         raise RuntimeError(
@@ -23,22 +65,64 @@ def _load_credentials_from_env() -> Credentials:
         )
 
     try:
-        info = json.loads(token_json)
+        _token_info = json.loads(token_json)
     except json.JSONDecodeError as e:
         raise RuntimeError("GMAIL_TOKEN_JSON is not valid JSON.") from e
 
-    creds = Credentials.from_authorized_user_info(info, SCOPES)
+    return _token_info
+
+
+def _load_credentials_from_env() -> Credentials:
+    """
+    Carrega credenciais a partir da variável de ambiente GMAIL_TOKEN_JSON.
+    """
+    creds = Credentials.from_authorized_user_info(_load_token_info(), SCOPES)
 
     # Se expirou e tiver refresh_token, renova automaticamente
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
+    _refresh_if_needed(creds)
 
     return creds
 
 
+def _needs_refresh(creds: Credentials) -> bool:
+    # Compara a expiry explicitamente (naive UTC, como o google-auth guarda),
+    # com uma margem para não usar um token que expira no meio do batch
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now >= creds.expiry - REFRESH_MARGIN
+
+
+def _refresh_if_needed(creds: Credentials) -> None:
+    """
+    Single-flight: só uma thread faz o refresh (um RTT ao oauth2.googleapis.com);
+    as outras esperam no lock e reaproveitam o token novo.
+    """
+    if not creds.refresh_token or not _needs_refresh(creds):
+        return
+    with _refresh_lock:
+        if _needs_refresh(creds):
+            creds.refresh(Request())
+
+
 def get_gmail_service():
-    creds = _load_credentials_from_env()
+    """
+    Reaproveita o mesmo Resource (e o transporte HTTP) entre execuções;
+    só recria as credenciais na primeira chamada e só renova o token quando expira.
+    """
+    global _creds, _service
+
+    if _service is not None and not _needs_refresh(_creds):
+        return _service
+
+    if _creds is None:
+        _creds = _load_credentials_from_env()
+    else:
+        _refresh_if_needed(_creds)
 
+    creds = _creds
     if not creds or not creds.valid:
         # Se não tem refresh_token, não tem como renovar no servidor
         if not creds.refresh_token:
@@ -48,28 +132,204 @@ def get_gmail_service():
             )
         raise RuntimeError("Gmail credentials invalid even after refresh attempt.")
 
-    return build("gmail", "v1", credentials=creds)
+    if _service is None:
+        # cache_discovery=False: usa o discovery doc empacotado, sem fetch/file_cache
+        _service = build("gmail", "v1", credentials=creds, cache_discovery=False)
+    return _service
+
+
+def _message_to_email(msg: Dict[str, Any]) -> Dict[str, Any]:
+    # Um único dict por mensagem; nomes de header não têm caixa garantida
+    headers = {
+        h["name"].lower(): h.get("value", "")
+        for h in msg.get("payload", {}).get("headers", [])
+    }
+    return {
+        "id": msg.get("id"),
+        "threadId": msg.get("threadId"),
+        "subject": headers.get("subject", ""),
+        "from": headers.get("from", ""),
+        "date": headers.get("date", ""),
+        "snippet": msg.get("snippet", ""),
+    }
+
+
+def _get_request(service, msg_id: str):
+    return service.users().messages().get(
+        userId="me",
+        id=msg_id,
+        format=MESSAGE_FORMAT,
+        metadataHeaders=METADATA_HEADERS,
+        fields=GET_FIELDS,
+    )
+
+
+def _fetch_messages_batch(service, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Busca os metadados em lotes (um único POST /batch por até 100 mensagens)
+    em vez de um GET por mensagem.
+    """
+    fetched: Dict[str, Dict[str, Any]] = {}
+
+    def _on_msg(request_id, response, exception):
+        if exception is not None:
+            print(f"[WARN] Gmail get failed id={request_id}: {exception}")
+            return
+        fetched[request_id] = response
+
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_on_msg)
+        for msg_id in ids[start : start + BATCH_SIZE]:
+            batch.add(_get_request(service, msg_id), request_id=msg_id)
+        batch.execute()
+
+    return fetched
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Um único pool para o processo inteiro (o worker roda para sempre)
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="gmail-get")
+    return _executor
+
+
+def _thread_http(credentials) -> AuthorizedHttp:
+    # httplib2 não é thread-safe: cada thread usa o seu próprio transporte
+    http = getattr(_thread_local, "http", None)
+    if http is None or http.credentials is not credentials:
+        http = AuthorizedHttp(credentials, http=httplib2.Http())
+        _thread_local.http = http
+    return http
+
+
+def _fetch_messages_parallel(service, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Fallback sem batch: dispara os GETs em paralelo num pool de threads,
+    então a latência fica ~1 RTT em vez de N RTTs.
+    """
+
+    def _fetch(msg_id: str):
+        req = _get_request(service, msg_id)
+        try:
+            return msg_id, req.execute(http=_thread_http(req.http.credentials))
+        except HttpError as e:
+            print(f"[WARN] Gmail get failed id={msg_id}: {e}")
+            return msg_id, None
+
+    return {
+        msg_id: msg
+        for msg_id, msg in _get_executor().map(_fetch, ids)
+        if msg is not None
+    }
+
+
+def _fetch_messages(service, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    if not ids:
+        return {}
+    if hasattr(service, "new_batch_http_request"):
+        try:
+            return _fetch_messages_batch(service, ids)
+        except HttpError as e:
+            print(f"[WARN] Gmail batch failed, falling back to parallel gets: {e}")
+    return _fetch_messages_parallel(service, ids)
+
 
+def _mailbox_changed(service, history_id: str) -> Optional[str]:
+    """
+    Sync parcial via History API: retorna o historyId atual se nada foi
+    adicionado/removido desde `history_id`, ou None se houve mudança
+    (ou se o historyId expirou e precisamos de um sync completo).
+    Mover para Lixeira/Spam é label (TRASH/SPAM), não messageDeleted: por isso
+    mudança de label também força o sync completo.
+    """
+    try:
+        resp = (
+            service.users()
+            .history()
+            .list(
+                userId="me",
+                startHistoryId=history_id,
+                historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+                maxResults=1,
+                fields="history/id,historyId",
+            )
+            .execute()
+        )
+    except HttpError as e:
+        # 404 = historyId antigo demais; qualquer outro erro também cai no sync completo
+        print(f"[WARN] Gmail history.list failed, doing full sync: {e}")
+        return None
+
+    if resp.get("history"):
+        return None
+    return resp.get("historyId") or history_id
+
+
+def list_recent_emails(
+    max_results: int = 5, state: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Lista os emails mais recentes (mais recentes primeiro).
 
-def list_recent_emails(max_results: int = 5) -> List[Dict[str, Any]]:
+    Se `state` for passado, usa-o como cache:
+    - state["history_id"]: se a caixa não mudou, devolve a última lista sem
+      chamar messages.list nem buscar metadados de novo;
+    - state["items"]: metadados por message id — só busca os ids novos.
+    """
     service = get_gmail_service()
 
-    results = service.users().messages().list(userId="me", maxResults=max_results).execute()
-    messages = results.get("messages", [])
+    items = None
+    if state is not None:
+        items = state.get("items")
+        if not isinstance(items, dict):
+            items = state["items"] = {}
+
+    if state is not None and state.get("history_id") and state.get("recent_max") == max_results:
+        history_id = _mailbox_changed(service, state["history_id"])
+        if history_id:
+            state["history_id"] = history_id
+            ts = now_ts()
+            emails = []
+            for msg_id in state.get("recent", []):
+                if msg_id in items:
+                    # reaproveita o registro inteiro (inclui a classificação do summarizer)
+                    touch_item(state, msg_id, items[msg_id], ts)
+                    emails.append(items[msg_id]["email"])
+            return emails
+
+    history_id = None
+    if state is not None:
+        # Captura antes do list: o que chegar depois aparece no próximo history.list
+        history_id = service.users().getProfile(userId="me", fields="historyId").execute().get("historyId")
+
+    results = (
+        service.users()
+        .messages()
+        .list(userId="me", maxResults=max_results, fields="messages/id")
+        .execute()
+    )
+    ids = [m["id"] for m in results.get("messages", [])]
+
+    known = items if items is not None else {}
+    fetched = _fetch_messages(service, [i for i in ids if i not in known])
 
     emails = []
-    for m in messages:
-        msg = service.users().messages().get(userId="me", id=m["id"], format="metadata").execute()
-        headers = {h["name"]: h["value"] for h in msg.get("payload", {}).get("headers", [])}
-
-        emails.append(
-            {
-                "id": msg.get("id"),
-                "threadId": msg.get("threadId"),
-                "subject": headers.get("Subject", ""),
-                "from": headers.get("From", ""),
-                "date": headers.get("Date", ""),
-            }
-        )
+    ts = now_ts()
+    for msg_id in ids:  # mantém a ordem do list (mais recentes primeiro)
+        if msg_id in fetched:
+            email = _message_to_email(fetched[msg_id])
+        elif msg_id in known:
+            email = known[msg_id]["email"]
+        else:
+            continue
+        emails.append(email)
+        if state is not None:
+            touch_item(state, msg_id, known.get(msg_id) or {"email": email}, ts)
+
+    if state is not None:
+        state["history_id"] = history_id
+        state["recent_max"] = max_results
+        state["recent"] = [e["id"] for e in emails]
 
     return emails
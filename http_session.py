@@ -0,0 +1,30 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session() -> requests.Session:
+    """
+    Sessão HTTPS com keep-alive para os senders (Telegram/WhatsApp): uma por
+    módulo evita novo handshake TCP+TLS a cada envio. Só re-tenta falhas de
+    conexão e 429 (mensagem não entregue), nunca um POST que já chegou.
+    """
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3,
+                connect=3,
+                read=0,
+                status_forcelist=(429,),
+                allowed_methods=frozenset({"POST"}),
+                backoff_factor=0.3,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        ),
+    )
+    return session
@@ -1,9 +1,13 @@
 import os
-import time
+import re
+import signal
+import threading
+from bisect import bisect_right
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 from gmail_client import list_recent_emails
+from state_store import load_state, prune_old, save_state
 from telegram_sender import send_telegram_message
 from summarizer import build_items, build_summary_from_items
 
@@ -15,28 +19,48 @@ TZ_NAME = os.getenv("TIMEZONE", "America/Sao_Paulo")
 RUN_TIMES = os.getenv("RUN_TIMES", "09:00,12:00,18:00")
 MAX_RESULTS = int(os.getenv("MAX_RESULTS", "30"))
 HEARTBEAT_WHEN_EMPTY = os.getenv("HEARTBEAT_WHEN_EMPTY", "1") == "1"
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_DAYS", "14")) * 86400
+MAX_WAIT_CHUNK_S = 60
 
 
 # =========================
 # FUNÇÕES DE APOIO
 # =========================
+_TIME_RE = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*$")
+
+
 def parse_times(times_csv: str):
-    slots = []
+    """
+    "09:00,12:00,18:00" -> [(9, 0, "09:00"), (12, 0, "12:00"), (18, 0, "18:00")]
+    Valida tudo de uma vez (no boot), em vez de estourar no meio do loop.
+    """
+    slots = set()
     for part in times_csv.split(","):
-        part = part.strip()
-        if not part:
+        if not part.strip():
             continue
-        hh, mm = part.split(":")
-        slots.append((int(hh), int(mm), part))
-    slots.sort()
-    return slots
+        m = _TIME_RE.match(part)
+        hh, mm = (int(m.group(1)), int(m.group(2))) if m else (-1, -1)
+        if not (0 <= hh < 24 and 0 <= mm < 60):
+            raise RuntimeError(f"RUN_TIMES inválido: {part.strip()!r}. Ex: 09:00,12:00,18:00")
+        slots.add((hh, mm, f"{hh:02d}:{mm:02d}"))
+    return sorted(slots)
+
+
+def slot_seconds(schedule):
+    # Cada slot como segundos desde a meia-noite (lista ordenada, p/ bisect)
+    return [hh * 3600 + mm * 60 for hh, mm, _ in schedule]
 
 
-def next_run(now: datetime, schedule):
-    for hh, mm, label in schedule:
-        candidate = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
-        if candidate > now:
-            return candidate, label
+def next_run(now: datetime, schedule, slot_sods=None):
+    if slot_sods is None:
+        slot_sods = slot_seconds(schedule)
+
+    # primeiro slot estritamente depois de agora
+    now_sod = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+    idx = bisect_right(slot_sods, now_sod)
+    if idx < len(schedule):
+        hh, mm, label = schedule[idx]
+        return now.replace(hour=hh, minute=mm, second=0, microsecond=0), label
 
     # próximo dia
     hh, mm, label = schedule[0]
@@ -46,6 +70,15 @@ def next_run(now: datetime, schedule):
     return tomorrow, label
 
 
+# Calculados uma vez no import (as envs não mudam durante o processo)
+TZ = ZoneInfo(TZ_NAME)
+SCHEDULE = parse_times(RUN_TIMES)
+SLOT_SODS = slot_seconds(SCHEDULE)
+
+if not SCHEDULE:
+    raise RuntimeError("RUN_TIMES inválido. Ex: 09:00,12:00,18:00")
+
+
 # =========================
 # EXECUÇÃO ÚNICA
 # =========================
@@ -53,7 +86,10 @@ def run_once(now: datetime, slot: str):
     print(f"[RUN] slot={slot} now={now.isoformat()} max_results={MAX_RESULTS}")
 
     try:
-        emails = list_recent_emails(max_results=MAX_RESULTS) or []
+        # O state guarda o historyId e os metadados já vistos: evita list + gets repetidos
+        state = load_state()
+        emails = list_recent_emails(max_results=MAX_RESULTS, state=state) or []
+        save_state(prune_old(state, STATE_TTL_SECONDS))
     except Exception as e:
         print(f"[ERROR] Gmail fetch failed: {type(e).__name__}: {e}")
         return
@@ -76,7 +112,9 @@ def run_once(now: datetime, slot: str):
                 )
             return
 
-        summary = build_summary_from_items(items)
+        # Com o state, só emails ainda não classificados vão para o LLM
+        summary = build_summary_from_items(items, state=state)
+        save_state(state)
         if summary and summary.strip():
             send_telegram_message(summary)
 
@@ -92,12 +130,35 @@ def run_once(now: datetime, slot: str):
 # =========================
 # LOOP PRINCIPAL
 # =========================
+_stop = threading.Event()
+
+
+def _request_stop(signum, frame):
+    print(f"[SIGNAL] received {signal.Signals(signum).name}, stopping")
+    _stop.set()
+
+
+def _wait_until(target: datetime, tz) -> bool:
+    """
+    Espera até `target` em fatias de no máximo MAX_WAIT_CHUNK_S, recalculando
+    pelo relógio a cada fatia (recupera saltos de NTP/suspend em ~1 min).
+    Retorna True se recebeu sinal de parada (SIGTERM/SIGINT) no meio.
+    """
+    while True:
+        remaining = (target - datetime.now(tz)).total_seconds()
+        if remaining <= 0:
+            return _stop.is_set()
+        if _stop.wait(min(remaining, MAX_WAIT_CHUNK_S)):
+            return True
+
+
 def main_loop():
-    tz = ZoneInfo(TZ_NAME)
-    schedule = parse_times(RUN_TIMES)
+    tz = TZ
+    schedule = SCHEDULE
 
-    if not schedule:
-        raise RuntimeError("RUN_TIMES inválido. Ex: 09:00,12:00,18:00")
+    # Container stop (SIGTERM) acorda o loop na hora, em vez de esperar o sleep
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
 
     print(
         f"BOOT: worker loop started | "
@@ -106,15 +167,17 @@ def main_loop():
 
     while True:
         now = datetime.now(tz)
-        nxt, slot = next_run(now, schedule)
-        sleep_s = max(1, int((nxt - now).total_seconds()))
+        nxt, slot = next_run(now, schedule, SLOT_SODS)
+        # Só para o log: a espera real é do _wait_until, em fatias no _stop
+        sleep_s = max(1.0, (nxt - now).total_seconds())
 
         print(
             f"[SCHEDULE] now={now.isoformat()} "
-            f"next={nxt.isoformat()} slot={slot} sleep={sleep_s}s"
+            f"next={nxt.isoformat()} slot={slot} sleep={sleep_s:.0f}s"
         )
 
-        time.sleep(sleep_s)
+        if _wait_until(nxt, tz):
+            break
 
         try:
             run_once(datetime.now(tz), slot)
@@ -122,7 +185,10 @@ def main_loop():
             print(f"[FATAL] run_once crashed: {type(e).__name__}: {e}")
 
         # pequena pausa de segurança
-        time.sleep(5)
+        if _stop.wait(5):
+            break
+
+    print("BOOT: worker loop stopped")
 
 
 # =========================
@@ -1,17 +1,39 @@
 # state_store.py
 from __future__ import annotations
 
+import gzip
+import heapq
 import json
 import os
 import time
 from typing import Dict, Any
 
+try:
+    import orjson  # encoder/decoder em C, bem mais rápido que o json da stdlib
+except ImportError:  # fallback para o json da stdlib
+    orjson = None
+
 DEFAULT_STATE_PATH = os.getenv("STATE_PATH", "state.json")
 
+def _is_gzip(path: str) -> bool:
+    # STATE_PATH terminando em .gz liga a compressão (útil se o state ficar grande)
+    return path.endswith(".gz")
+
+def _encode(state: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(state, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _decode(data: bytes) -> Dict[str, Any]:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 def load_state(path: str = DEFAULT_STATE_PATH) -> Dict[str, Any]:
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        opener = gzip.open if _is_gzip(path) else open
+        with opener(path, "rb") as f:
+            return _decode(f.read())
     except FileNotFoundError:
         return {}
     except Exception:
@@ -20,25 +42,76 @@ def load_state(path: str = DEFAULT_STATE_PATH) -> Dict[str, Any]:
 
 def save_state(state: Dict[str, Any], path: str = DEFAULT_STATE_PATH) -> None:
     tmp_path = f"{path}.tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    data = _encode(state)
+    with open(tmp_path, "wb") as f:
+        if _is_gzip(path):
+            # compresslevel=1: quase todo o ganho de tamanho, custo mínimo de CPU
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1) as gz:
+                gz.write(data)
+        else:
+            f.write(data)
+        _fsync_file(f)
     os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path) or ".")
+
+def _fsync_file(f) -> None:
+    # Garante que o conteúdo do .tmp está no disco antes do rename
+    f.flush()
+    os.fsync(f.fileno())
+
+def _fsync_dir(dir_path: str) -> None:
+    # Persiste o próprio rename (entrada no diretório); nem todo SO suporta
+    try:
+        fd = os.open(dir_path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 def now_ts() -> int:
     return int(time.time())
 
+def touch_item(state: Dict[str, Any], key: str, value: Dict[str, Any], ts: int) -> None:
+    """
+    Grava/atualiza state["items"][key] com last_seen=ts e agenda a expiração
+    no heap usado por prune_old.
+    """
+    value["last_seen"] = ts
+    state.setdefault("items", {})[key] = value
+    heap = state.get("_exp_heap")
+    if isinstance(heap, list):
+        heapq.heappush(heap, [ts, key])
+
+
 def prune_old(state: Dict[str, Any], ttl_seconds: int) -> Dict[str, Any]:
     """
     Remove chaves antigas (evita state crescer indefinidamente).
+
+    Usa um min-heap de (last_seen, key) em state["_exp_heap"]: só desempilha
+    o que de fato expirou, em vez de varrer todos os items a cada execução.
+    Entradas antigas de chaves que foram vistas de novo são só descartadas.
     """
     ts = now_ts()
     items = state.get("items", {})
     if not isinstance(items, dict):
         items = {}
-    new_items = {}
-    for k, v in items.items():
-        last_seen = int(v.get("last_seen", 0) or 0)
-        if ts - last_seen <= ttl_seconds:
-            new_items[k] = v
-    state["items"] = new_items
+    state["items"] = items
+
+    heap = state.get("_exp_heap")
+    if not isinstance(heap, list):
+        # Primeira vez (ou state antigo): reconstrói a partir dos items
+        heap = [[int(v.get("last_seen", 0) or 0), k] for k, v in items.items()]
+        heapq.heapify(heap)
+        state["_exp_heap"] = heap
+
+    cutoff = ts - ttl_seconds
+    while heap and heap[0][0] < cutoff:
+        last_seen, key = heapq.heappop(heap)
+        rec = items.get(key)
+        if rec is not None and int(rec.get("last_seen", 0) or 0) == last_seen:
+            del items[key]
     return state
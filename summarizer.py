@@ -1,14 +1,39 @@
 # summarizer.py
+import hashlib
+import html
+import importlib.util
+import io
 import json
 import os
+import random
+import re
+import threading
 import time
-from typing import Any, Dict, List
-
-from openai import OpenAI
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+from openai import (
+    APIConnectionError,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+
+try:
+    import orjson
+except ImportError:  # fallback para o json da stdlib
+    orjson = None
 
 
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 MAX_ITEMS = int(os.getenv("SUMMARY_MAX_ITEMS", "30"))
+MAX_SNIPPET = int(os.getenv("SUMMARY_MAX_SNIPPET", "200"))  # corta na entrada; nada depois precisa de mais
+SIMHASH_MAX_DISTANCE = int(os.getenv("SUMMARY_SIMHASH_DISTANCE", "3"))  # 0 desliga o agrupamento de quase-cópias
 
 # Novos controles de “poluição” na BAIXA
 LOW_MAX_ITEMS = int(os.getenv("LOW_MAX_ITEMS", "5"))  # quantos itens BAIXA listar no máximo
@@ -18,130 +43,559 @@ LOW_GROUP_REST = os.getenv("LOW_GROUP_REST", "1") == "1"  # se 1, agrupa o resto
 REQUEST_TIMEOUT_S = float(os.getenv("OPENAI_TIMEOUT_S", "30"))
 RETRIES = int(os.getenv("OPENAI_RETRIES", "2"))
 SLEEP_BETWEEN_RETRIES_S = float(os.getenv("OPENAI_RETRY_SLEEP_S", "2"))
+# HTTP/2 multiplexa os chunks paralelos numa conexão só; "auto" liga se o h2
+# estiver instalado (`pip install httpx[http2]`), "0"/"1" forçam
+_HTTP2_ENV = os.getenv("OPENAI_HTTP2", "auto")
+OPENAI_HTTP2 = _HTTP2_ENV == "1" or (_HTTP2_ENV == "auto" and importlib.util.find_spec("h2") is not None)
+# 0 = classificação estável entre execuções; vazio omite (modelos de raciocínio não aceitam)
+_TEMPERATURE_ENV = os.getenv("OPENAI_TEMPERATURE", "0")
+TEMPERATURE = float(_TEMPERATURE_ENV) if _TEMPERATURE_ENV else None
+
+RESULT_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "128"))
+
+# Suba sempre que INSTRUCTIONS/schema mudarem: invalida as classificações salvas no state
+PROMPT_VERSION = "4"
+
+# Se > 0, divide os emails em chunks desse tamanho e chama o LLM em paralelo
+CHUNK_SIZE = int(os.getenv("SUMMARY_CHUNK_SIZE", "0"))
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "4"))
+
+# Execuções agendadas não têm pressa: o Batch API custa ~metade (resultado em até 24h)
+USE_BATCH = os.getenv("OPENAI_USE_BATCH", "0") == "1"
+BATCH_POLL_S = float(os.getenv("OPENAI_BATCH_POLL_S", "30"))
+BATCH_MAX_WAIT_S = float(os.getenv("OPENAI_BATCH_MAX_WAIT_S", "3600"))
+
+# Erros transitórios (timeout/conexão, 429, 5xx); o resto sobe direto
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+_client = None
+_executor = None
+_result_cache: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def _get_client() -> OpenAI:
+    # Criado uma vez, na primeira chamada (o import não falha sem OPENAI_API_KEY).
+    # Pool com keep-alive longo: o retry e o próximo slot reaproveitam a conexão TLS.
+    global _client
+    if _client is None:
+        http_client = httpx.Client(
+            http2=OPENAI_HTTP2,
+            # Uma conexão viva por chamada paralela (chunks), sem refazer TLS
+            limits=httpx.Limits(
+                max_connections=max(4, OPENAI_CONCURRENCY),
+                max_keepalive_connections=max(4, OPENAI_CONCURRENCY),
+                keepalive_expiry=60.0,
+            ),
+            timeout=REQUEST_TIMEOUT_S,
+        )
+        # max_retries=0: o único retry é o de _request_openai_json (sem somar o backoff do SDK)
+        _client = OpenAI(http_client=http_client, max_retries=0)
+    return _client
 
-client = OpenAI()
 
+def _json_loads(raw: str) -> Any:
+    # orjson se disponível (mesmo padrão do state_store); erros dos dois são ValueError
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
 
-def _safe_get(d: Dict[str, Any], key: str, default=None):
-    try:
-        return d.get(key, default)
-    except Exception:
-        return default
+
+def _json_dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+_URL_RE = re.compile(r"https?://\S+")
+_TAG_RE = re.compile(r"<[^>]+>")
+_WORD_RE = re.compile(r"\w+")
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def _clean_snippet(text: str) -> str:
+    # URLs e HTML só gastam token; o modelo classifica pelo texto
+    text = _TAG_RE.sub(" ", html.unescape(text))
+    text = _URL_RE.sub("", text)
+    return " ".join(text.split())[:MAX_SNIPPET]
 
 
 def _email_to_item(e: Dict[str, Any]) -> Dict[str, Any]:
-    subject = _safe_get(e, "subject", "") or _safe_get(e, "Subject", "") or ""
-    frm = _safe_get(e, "from", "") or _safe_get(e, "From", "") or ""
-    snippet = _safe_get(e, "snippet", "") or _safe_get(e, "body", "") or ""
-    date = _safe_get(e, "date", "") or _safe_get(e, "internalDate", "") or ""
+    subject = e.get("subject") or e.get("Subject") or ""
+    frm = e.get("from") or e.get("From") or ""
+    snippet = e.get("snippet") or e.get("body") or ""
 
     return {
+        "ids": [e["id"]] if e.get("id") else [],
         "subject": str(subject).strip(),
         "from": str(frm).strip(),
-        "date": str(date).strip(),
-        "snippet": str(snippet).strip(),
+        "snippet": _clean_snippet(str(snippet)),
     }
 
 
-def build_items(emails: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    items = []
-    for e in (emails or [])[:MAX_ITEMS]:
-        items.append(_email_to_item(e))
-    return items
+def _norm_key(s: str) -> str:
+    return " ".join(s.lower().split())
 
 
-def _build_prompt(items: List[Dict[str, Any]]) -> str:
-    lines = []
-    for i, it in enumerate(items, start=1):
-        lines.append(
-            f"{i}) FROM: {it.get('from','')}\n"
-            f"   SUBJECT: {it.get('subject','')}\n"
-            f"   SNIPPET: {it.get('snippet','')}\n"
+def _dedupe_key(it: Dict[str, Any]) -> bytes:
+    # Impressão digital de 16 bytes; ignora caixa/espaços e só olha o começo do snippet
+    raw = f"{_norm_key(it['subject'])}|{_norm_key(it['from'])}|{_norm_key(it['snippet'])[:120]}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+
+def _simhash(text: str) -> int:
+    # SimHash de 64 bits sobre os tokens: textos quase iguais ficam a poucos bits de distância
+    weights = [0] * 64
+    for tok in _WORD_RE.findall(text):
+        h = int.from_bytes(hashlib.blake2b(tok.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit, w in enumerate(weights) if w > 0)
+
+
+def build_items(emails: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Normaliza os emails e junta cópias idênticas (mesmo assunto/remetente/snippet)
+    num único item com "count", para não gastar prompt repetindo o mesmo email.
+    Com SIMHASH_MAX_DISTANCE > 0, também junta quase-cópias (remetente, assunto
+    e snippet com variações mínimas) no item mais recente — nunca se os números
+    diferirem (valor, vencimento, código): dois boletos distintos ficam separados.
+    """
+    grouped: Dict[bytes, Dict[str, Any]] = {}
+    reps: List[Any] = []  # (simhash, números, item) de cada representante
+    out: List[Dict[str, Any]] = []
+    # islice: aceita qualquer iterável (ex.: gerador) e não toca no que passa de MAX_ITEMS
+    for e in islice(emails or (), MAX_ITEMS):
+        if not isinstance(e, dict):
+            continue
+        it = _email_to_item(e)
+        key = _dedupe_key(it)
+        rep = grouped.get(key)
+
+        if rep is None and SIMHASH_MAX_DISTANCE > 0:
+            sh = _simhash(f"{_norm_key(it['from'])} {_norm_key(it['subject'])} {_norm_key(it['snippet'])}")
+            digits = _DIGITS_RE.findall(f"{it['subject']} {it['snippet']}")
+            rep = next(
+                (r for h, d, r in reps if d == digits and bin(h ^ sh).count("1") <= SIMHASH_MAX_DISTANCE),
+                None,
+            )
+            if rep is None:
+                reps.append((sh, digits, it))
+
+        if rep is not None:
+            rep["count"] += 1
+            rep["ids"].extend(it["ids"])
+            grouped[key] = rep
+        else:
+            it["count"] = 1
+            grouped[key] = it
+            out.append(it)
+    return out
+
+
+def _tsv_field(value: Any) -> str:
+    # TAB/quebra de linha dentro do campo quebraria as colunas
+    return " ".join(str(value or "").split())
+
+
+# =========================
+# PRÉ-FILTRO LOCAL
+# =========================
+# Promo/newsletter/alerta técnico sem nenhum sinal de cobrança ou prazo vai
+# direto para BAIXA, sem gastar chamada ao LLM.
+# Tudo em ASCII: o texto passa por _deaccent antes (sem alternâncias tipo (ç|c))
+HIGH_INTENT_PATTERNS = [
+    r"\bfatura",
+    r"\bbolet[oa]s?\b",
+    r"\bpagamento",
+    r"\bvenc(e|imento|er|ida|ido)\b",
+    r"\bcobranca",
+    r"\bparcela",
+    r"\bpix\b",
+    r"\bcartao\b",
+    r"\bjuros\b",
+    r"\bmulta\b",
+    r"\bprotesto\b",
+    r"\bserasa\b",
+    r"\bimposto",
+    r"\biptu\b",
+    r"\baluguel\b",
+    r"\bcondominio\b",
+    r"\bmensalidade\b",
+    r"\bmatricula\b",
+    r"\bescola\b",
+    r"\brenovacao\b",
+    r"action required",
+]
+# Palavras soltas: o texto é tokenizado uma vez e cada uma vira um lookup O(1).
+# Variantes apontam para o mesmo radical, que conta uma vez só (como o antigo `"promo" in hay`).
+URGENT_WORDS = frozenset({"urgente", "importante", "prazo"})
+URGENT_PHRASES = ("acao necessaria", "ultimo dia")
+LOW_WORDS = {
+    "newsletter": "newsletter",
+    "newsletters": "newsletter",
+    "promo": "promo",
+    "promos": "promo",
+    "promocao": "promo",
+    "promocoes": "promo",
+    "promocional": "promo",
+    "desconto": "desconto",
+    "descontos": "desconto",
+    "oferta": "oferta",
+    "ofertas": "oferta",
+    "cupom": "cupom",
+    "cupons": "cupom",
+    "liquidacao": "liquida",
+}
+
+# Cobrança/falha de pagamento em inglês (comum em Cloud/SaaS). Qualquer sinal
+# de dinheiro ou prazo — daqui ou de HIGH_INTENT_PATTERNS — impede o BAIXA automático.
+MONEY_PATTERNS = [
+    r"\binvoices?\b",
+    r"\bbills?\b",
+    r"\bpayments? (?:failed|declined|due|overdue|unsuccessful)\b",
+    r"\b(?:failed|declined|unsuccessful) payments?\b",
+    r"\bpast due\b",
+    r"\boverdue\b",
+    r"\bcharges?\b",
+    r"\bcharged\b",
+    r"\bcard (?:declined|expired)\b",
+]
+
+# Só o domínio do remetente (depois do @), para "aws" não bater em "Lawson"
+TECH_SENDER_DOMAINS = [
+    "render.com",
+    "railway.app",
+    "github.com",
+    "vercel.com",
+    "amazonaws.com",
+    "aws.amazon.com",
+    "cloud.google.com",
+    "openai.com",
+]
+TECH_ALERT_PATTERNS = [
+    r"\bdeploy",
+    r"\bcrash",
+    r"\buptime\b",
+    r"\bincident",
+    r"\bbuild failed\b",
+    r"\bmonitor",
+    r"\bci/cd\b",
+]
+
+# Cada lista vira uma única alternação compilada no import (IGNORECASE, sem
+# .lower() por email): uma passada do motor de regex em vez de uma por padrão.
+_HIGH_INTENT_RE = re.compile("|".join(f"(?:{p})" for p in HIGH_INTENT_PATTERNS), re.IGNORECASE)
+_MONEY_RE = re.compile("|".join(f"(?:{p})" for p in MONEY_PATTERNS), re.IGNORECASE)
+_TECH_SENDER_RE = re.compile(
+    r"@(?:[\w-]+\.)*(?:" + "|".join(re.escape(d) for d in TECH_SENDER_DOMAINS) + r")\b", re.IGNORECASE
+)
+_TECH_ALERT_RE = re.compile("|".join(f"(?:{p})" for p in TECH_ALERT_PATTERNS), re.IGNORECASE)
+_NEWSLETTER_RE = re.compile(r"newsletter|manchetes|digest", re.IGNORECASE)
+_PROMO_RE = re.compile(r"promo|desconto|oferta|cupom|liquida", re.IGNORECASE)
+
+# Opt-in: abaixo desse score o email nem vai ao LLM (ex.: 20); 0 = tudo vai ao LLM
+LOCAL_LOW_SCORE = int(os.getenv("SUMMARY_LOCAL_LOW_SCORE", "0"))
+
+
+def _deaccent(text: str) -> str:
+    # "cobrança" -> "cobranca": remove só as marcas combinantes (emoji etc. ficam)
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def _looks_like_tech_alert(sender: str, hay: str) -> bool:
+    return _TECH_SENDER_RE.search(sender) is not None or _TECH_ALERT_RE.search(hay) is not None
+
+
+def _intent_score(hay: str, tech_alert: bool) -> int:
+    """
+    Score local 0–100 (50 = neutro): sobe com palavras de urgência, desce com
+    promo/newsletter e alertas técnicos. `hay` já vem em minúsculas e sem acento.
+    Sinal de conta/prazo não entra aqui: esse email nem chega ao score (ver _local_low_row).
+    """
+    toks = set(_WORD_RE.findall(hay))
+    score = 50
+    score += 10 * (len(toks & URGENT_WORDS) + sum(1 for p in URGENT_PHRASES if p in hay))
+    score -= 20 * len({LOW_WORDS[t] for t in toks if t in LOW_WORDS})
+    if tech_alert:
+        score -= 35
+    return max(0, min(100, score))
+
+
+def _human_summary(hay: str, tech_alert: bool) -> str:
+    if _NEWSLETTER_RE.search(hay):
+        return "Newsletter — leitura opcional, quando der."
+    if _PROMO_RE.search(hay):
+        return "Promoção/oferta — dá pra ignorar tranquilo."
+    if tech_alert:
+        return "Alerta técnico automático, sem impacto no seu bolso."
+    return "Nada de prazo ou cobrança aqui."
+
+
+@lru_cache(maxsize=4096)
+def _prefilter(subject: str, sender: str, snippet: str) -> Tuple[int, str, bool]:
+    """
+    (score local, resumo pronto, tem sinal de dinheiro/prazo). Memoizado pelo
+    conteúdo: no worker de longa duração, os mesmos emails (e rajadas de
+    alertas idênticos) voltam a cada slot e não repetem o trabalho de regex.
+    """
+    # Alerta técnico/newsletter/promo olham só assunto+trecho (o remetente já
+    # tem o teste de domínio); palavras de score e cobrança incluem o remetente
+    body = _deaccent(f"{subject}\n{snippet}".lower())
+    hay = f"{body}\n{_deaccent(sender.lower())}"
+    tech_alert = _looks_like_tech_alert(sender, body)
+    has_intent = _MONEY_RE.search(hay) is not None or _HIGH_INTENT_RE.search(hay) is not None
+    return _intent_score(hay, tech_alert), _human_summary(body, tech_alert), has_intent
+
+
+def _local_low_row(it: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Linha BAIXA pronta se o pré-filtro tiver certeza; None = manda para o LLM
+    score, resumo, has_intent = _prefilter(it["subject"], it["from"], it["snippet"])
+    # Cobrança/prazo nunca é rebaixado localmente (mesmo vindo de remetente técnico):
+    # quem decide é o LLM, que sobe alerta técnico com risco financeiro
+    if has_intent or score >= LOCAL_LOW_SCORE:
+        return None
+    return {
+        "score": score,
+        "titulo": it["subject"] or it["from"],
+        "resumo": resumo,
+        "acao": "",
+        "util": False,
+    }
+
+
+def _fmt_prompt_item(i: int, it: Dict[str, Any]) -> str:
+    # Uma linha TSV por email: bem menos tokens que rótulos FROM:/SUBJECT: repetidos
+    return "\t".join(
+        (
+            str(i),
+            str(it.get("count", 1)),
+            _tsv_field(it.get("from")),
+            _tsv_field(it.get("subject")),
+            _tsv_field(it.get("snippet")),
         )
-    emails_block = "\n".join(lines)
-
-    return f"""
-Você é meu assistente pessoal. Seu trabalho é me ajudar a NÃO perder prazos e a focar no que importa.
-
-### Prioridade máxima (suba score e coloque em ALTA quando aparecer)
-- Banco/contas: boleto, fatura, parcela, cobrança, pagamento, vencimento, débito, Pix, cartão, juros, multa, protesto, Serasa, imposto.
-- Moradia: aluguel, condomínio, IPTU, energia, água, internet, telefone.
-- Escola: mensalidade, reunião, recados, agenda, documentos, matrícula.
-- Qualquer coisa com data limite (“vence hoje/amanhã”, “último dia”, “prazo”, “renovação”, “action required”).
-
-### Regras fortes (importante)
-1) Alertas técnicos e TI DEVEM SER BAIXA por padrão:
-   - Render, Railway, GitHub, deploy, crash, logs, uptime, API key, billing setup de API/Cloud (Gemini/OpenAI/AWS/GCP), incident, monitoring, SRE, CI/CD.
-   - Só suba para MÉDIA/ALTA se houver risco direto financeiro pessoal (ex.: cobrança real, fatura vencendo, pagamento pendente no cartão).
-2) Newsletters, promoções e convites sociais tendem a BAIXA.
-
-### Regras para reduzir poluição (BAIXA)
-- Evite listar dezenas de itens irrelevantes.
-- Use o campo "util" para marcar BAIXA que ainda vale a pena mostrar (ex.: confirmação de pagamento, comprovante, recibo, rastreio/entrega, confirmação de reserva).
-- Promoções/newsletters/convites sociais/alertas técnicos normalmente NÃO são "util".
-
-### Tom
-Quero um tom humano. Nada de “sem sinais fortes de…”.
-Diga o tema em 1 linha com um porquê curto.
-Ação prática objetiva.
-
-### Saída obrigatória
-Responda em JSON válido, exatamente neste formato:
-
-{{
-  "alta": [{{"score": 0, "titulo": "", "resumo": "", "acao": ""}}],
-  "media": [{{"score": 0, "titulo": "", "resumo": "", "acao": ""}}],
-  "baixa": [{{"score": 0, "titulo": "", "resumo": "", "acao": "", "util": false}}]
-}}
-
-### Critério de score (guia rápido)
-- 90–100: prazo muito curto / cobrança / pagamento / risco claro.
-- 80–89: importante mas não “agora-agora”.
-- 50–79: relevante, mas sem urgência evidente.
-- 0–49: dispensável / promo / newsletter / social / TI.
-
-Aqui estão os emails (mais recentes primeiro):
-
-{emails_block}
+    )
+
+
+# Regras fixas, enviadas como `instructions`: o prefixo idêntico entre chamadas
+# aproveita o prompt caching automático da OpenAI (input mais barato e rápido)
+INSTRUCTIONS = """
+Você é meu assistente pessoal: classifique meus emails para eu não perder prazos.
+
+ALTA (score 90–100 se prazo curto/cobrança/risco; 80–89 se importante sem urgência):
+- banco/contas: boleto, fatura, parcela, cobrança, pagamento, vencimento, débito, Pix, cartão, juros, multa, protesto, Serasa, imposto
+- moradia: aluguel, condomínio, IPTU, energia, água, internet, telefone
+- escola: mensalidade, reunião, recados, agenda, documentos, matrícula
+- qualquer data limite (vence hoje/amanhã, último dia, prazo, renovação, action required)
+
+MÉDIA (50–79): relevante, sem urgência evidente.
+
+BAIXA (0–49): promoções, newsletters, convites sociais e alertas técnicos/TI
+(Render, Railway, GitHub, deploy, crash, logs, uptime, API key, billing de API/Cloud, incident, monitoring, CI/CD).
+TI só sobe se houver risco financeiro pessoal direto (cobrança real, fatura vencendo).
+"util"=true só para BAIXA que vale mostrar (pagamento confirmado, comprovante, recibo, rastreio/entrega, reserva); não liste dezenas de irrelevantes.
+
+Tom humano: titulo = tema em 1 linha com um porquê curto; acao = ação prática objetiva. Nada de “sem sinais fortes de…”.
+Os emails vêm em TSV (n, qtd de cópias recebidas, remetente, assunto, trecho).
+Em cada item, "n" é o número do email na coluna n.
 """.strip()
 
 
+PROMPT_HEADER = "n\tqtd\tde\tassunto\ttrecho"
+
+
+def _build_prompt(items: List[Dict[str, Any]]) -> str:
+    # Só a parte variável; as regras fixas vão em INSTRUCTIONS
+    emails_block = "\n".join([_fmt_prompt_item(i, it) for i, it in enumerate(items, start=1)])
+    return f"Emails (mais recentes primeiro):\n{PROMPT_HEADER}\n{emails_block}"
+
+
+def _cache_key(prompt: str) -> bytes:
+    return hashlib.blake2b(f"{MODEL}\n{PROMPT_VERSION}\n{prompt}".encode("utf-8"), digest_size=16).digest()
+
+
 def _call_openai_for_json(prompt: str) -> Dict[str, Any]:
-    last_err = None
+    """
+    Mesmo prompt (mesmos emails) => mesma resposta: reaproveita do cache LRU
+    em memória em vez de refazer a chamada (retries, reexecuções do mesmo slot).
+    """
+    key = _cache_key(prompt)
+    with _result_cache_lock:
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+            return _result_cache[key]
+
+    data = _request_openai_json(prompt)
+    with _result_cache_lock:
+        _result_cache[key] = data
+        if len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+    return data
+
+
+def _item_schema(with_util: bool) -> Dict[str, Any]:
+    props = {
+        "n": {"type": "integer"},
+        "score": {"type": "integer"},
+        "titulo": {"type": "string"},
+        "resumo": {"type": "string"},
+        "acao": {"type": "string"},
+    }
+    if with_util:
+        props["util"] = {"type": "boolean"}
+    return {
+        "type": "object",
+        "properties": props,
+        "required": list(props),
+        "additionalProperties": False,
+    }
+
 
-    for attempt in range(RETRIES):
+# Structured Outputs (strict): o modelo só pode devolver exatamente este formato,
+# então não precisamos descrever o JSON no prompt nem re-tentar por JSON inválido
+TRIAGE_FORMAT = {
+    "type": "json_schema",
+    "name": "triage",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "alta": {"type": "array", "items": _item_schema(False)},
+            "media": {"type": "array", "items": _item_schema(False)},
+            "baixa": {"type": "array", "items": _item_schema(True)},
+        },
+        "required": ["alta", "media", "baixa"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _response_body(prompt: str) -> Dict[str, Any]:
+    # Mesmo corpo no tempo real e no Batch API
+    body = {
+        "model": MODEL,
+        "instructions": INSTRUCTIONS,
+        "input": prompt,
+        "text": {"format": TRIAGE_FORMAT},
+    }
+    if TEMPERATURE is not None:
+        body["temperature"] = TEMPERATURE
+    return body
+
+
+def _parse_json_text(text: str) -> Dict[str, Any]:
+    raw = (text or "").strip()
+    if not raw:
+        raise ValueError("OpenAI returned empty text (cannot parse JSON)")
+
+    data = _json_loads(raw)
+    if not isinstance(data, dict):
+        raise ValueError("JSON parsed but is not an object")
+    return data
+
+
+def _retry_delay(attempt: int, err: Exception) -> float:
+    """
+    Respeita o Retry-After do servidor (429/503); senão backoff exponencial
+    com jitter, para chunks paralelos não re-tentarem todos no mesmo instante.
+    """
+    response = getattr(err, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass  # formato HTTP-date: cai no backoff
+    backoff = SLEEP_BETWEEN_RETRIES_S * (2 ** attempt)
+    return backoff + random.uniform(0, backoff * 0.1)
+
+
+def _log_usage(resp) -> None:
+    # cached > 0 confirma que o prefixo fixo (INSTRUCTIONS) está pegando o prompt caching
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    print(
+        f"[OPENAI] input={usage.input_tokens} cached={cached} "
+        f"output={usage.output_tokens}"
+    )
+
+
+def _request_openai_json(prompt: str) -> Dict[str, Any]:
+    # Com o schema strict a resposta já vem válida: só re-tenta falhas de rede/servidor
+    # (BadRequest e afins não mudam na próxima tentativa)
+    attempts = max(1, RETRIES)
+    for attempt in range(attempts):
         try:
-            resp = client.responses.create(
-                model=MODEL,
-                input=prompt,
+            resp = _get_client().responses.create(
+                **_response_body(prompt),
                 timeout=REQUEST_TIMEOUT_S,
             )
-
-            text = ""
-            try:
-                text = resp.output_text or ""
-            except Exception:
-                text = ""
-
-            raw = (text or "").strip()
-            if not raw:
-                raise ValueError("OpenAI returned empty text (cannot parse JSON)")
-
-            if raw.startswith("```"):
-                raw = raw.strip("`")
-                raw = raw.replace("json", "", 1).strip()
-
-            data = json.loads(raw)
-            if not isinstance(data, dict):
-                raise ValueError("JSON parsed but is not an object")
-            return data
-
-        except Exception as e:
-            last_err = e
-            if attempt < RETRIES - 1:
-                time.sleep(SLEEP_BETWEEN_RETRIES_S)
+        except RETRYABLE_ERRORS as e:
+            if attempt < attempts - 1:
+                time.sleep(_retry_delay(attempt, e))
                 continue
-            raise last_err
+            raise
+
+        _log_usage(resp)
+        return _parse_json_text(resp.output_text or "")
+
+
+def _batch_output_text(body: Dict[str, Any]) -> str:
+    # No JSONL do batch vem o objeto cru (sem o atalho resp.output_text do SDK)
+    return "".join(
+        c.get("text", "")
+        for out in body.get("output") or []
+        if out.get("type") == "message"
+        for c in out.get("content") or []
+        if c.get("type") == "output_text"
+    )
+
+
+def _request_openai_batch(prompts: List[str]) -> List[Dict[str, Any]]:
+    """
+    Envia os prompts pelo Batch API (~50% mais barato, sem pressa):
+    sobe um JSONL, espera o batch terminar e devolve os JSON na mesma ordem.
+    """
+    client = _get_client()
+    lines = [
+        _json_dumps({"custom_id": str(i), "method": "POST", "url": "/v1/responses", "body": _response_body(p)})
+        for i, p in enumerate(prompts)
+    ]
+    batch_file = client.files.create(
+        file=("summary_batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+
+    deadline = time.monotonic() + BATCH_MAX_WAIT_S
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        if time.monotonic() >= deadline:
+            client.batches.cancel(batch.id)
+            raise TimeoutError(f"OpenAI batch {batch.id} not done after {BATCH_MAX_WAIT_S:.0f}s")
+        time.sleep(BATCH_POLL_S)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"OpenAI batch {batch.id} ended with status={batch.status}")
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        row = _json_loads(line)
+        resp = row.get("response") or {}
+        if row.get("error") or resp.get("status_code") != 200:
+            raise RuntimeError(f"OpenAI batch request {row.get('custom_id')} failed: {row.get('error') or resp}")
+        results[row["custom_id"]] = _parse_json_text(_batch_output_text(resp.get("body") or {}))
+
+    return [results[str(i)] for i in range(len(prompts))]
 
 
 def _normalize_list(x) -> List[Dict[str, Any]]:
@@ -158,14 +612,21 @@ def _trim_low(low: List[Dict[str, Any]]) -> (List[Dict[str, Any]], int):
     - Limita em LOW_MAX_ITEMS
     - Retorna (lista_final, qtd_agrupada)
     """
-    original_count = len(low)
-
+    limit = max(0, LOW_MAX_ITEMS)
     if LOW_SHOW_ONLY_USEFUL:
-        low = [it for it in low if bool(it.get("util"))]
+        # filtra e limita numa passada só (para assim que junta `limit` itens)
+        kept = list(islice((it for it in low if bool(it.get("util"))), limit))
+    else:
+        kept = low[:limit]
+
+    grouped = max(0, len(low) - len(kept))
+    return kept, grouped
 
-    low = low[: max(0, LOW_MAX_ITEMS)]
-    grouped = max(0, original_count - len(low))
-    return low, grouped
+
+# Linhas de cada item no Telegram (resumo/ação só aparecem se vierem preenchidos)
+_ITEM_HEAD = "{idx}) [{score}/100] {titulo}"
+_ITEM_RESUMO = "   • {resumo}\n"
+_ITEM_ACAO = "   • Ação: {acao}\n"
 
 
 def _format_message(data: Dict[str, Any]) -> str:
@@ -175,41 +636,175 @@ def _format_message(data: Dict[str, Any]) -> str:
 
     baixa_final, baixa_grouped = _trim_low(baixa)
 
-    def _fmt_block(title: str, arr: List[Dict[str, Any]]) -> str:
+    buf = io.StringIO()
+
+    def _fmt_block(title: str, arr: List[Dict[str, Any]]) -> None:
+        buf.write(f"{title}\n\n")
         if not arr:
-            return f"{title}\n\n(sem itens)\n"
-        out = [title, ""]
+            buf.write("(sem itens)\n")
+            return
         for idx, it in enumerate(arr, start=1):
-            score = it.get("score", "")
-            titulo = (it.get("titulo") or "").strip()
-            resumo = (it.get("resumo") or "").strip()
-            acao = (it.get("acao") or "").strip()
-
-            out.append(f"{idx}) [{score}/100] {titulo}".strip())
-            if resumo:
-                out.append(f"   • {resumo}")
-            if acao:
-                out.append(f"   • Ação: {acao}")
-            out.append("")
-        return "\n".join(out).rstrip() + "\n"
-
-    msg = ""
-    msg += _fmt_block("📌 Emails com prioridade ALTA", alta)
-    msg += "\n" + _fmt_block("🟡 Emails com prioridade MÉDIA", media)
+            row = {
+                "idx": idx,
+                "score": it.get("score", ""),
+                "titulo": (it.get("titulo") or "").strip(),
+                "resumo": (it.get("resumo") or "").strip(),
+                "acao": (it.get("acao") or "").strip(),
+            }
+            if idx > 1:
+                buf.write("\n")
+            buf.write(_ITEM_HEAD.format_map(row).strip() + "\n")
+            if row["resumo"]:
+                buf.write(_ITEM_RESUMO.format_map(row))
+            if row["acao"]:
+                buf.write(_ITEM_ACAO.format_map(row))
+
+    _fmt_block("📌 Emails com prioridade ALTA", alta)
+    buf.write("\n")
+    _fmt_block("🟡 Emails com prioridade MÉDIA", media)
 
     # BAIXA: só mostra a lista (já filtrada) e opcionalmente um “rodapé” agrupado
-    baixa_title = "⚪ Emails com prioridade BAIXA (ação opcional)"
-    msg += "\n" + _fmt_block(baixa_title, baixa_final)
+    buf.write("\n")
+    _fmt_block("⚪ Emails com prioridade BAIXA (ação opcional)", baixa_final)
 
     if LOW_GROUP_REST and baixa_grouped > 0:
-        msg += f"\n(🧹 Mais {baixa_grouped} emails irrelevantes/promoções foram ignorados pra não poluir.)\n"
+        buf.write(f"\n(🧹 Mais {baixa_grouped} emails irrelevantes/promoções foram ignorados pra não poluir.)\n")
 
-    return msg.strip()
+    return buf.getvalue().strip()
 
 
-def build_summary_from_items(items: List[Dict[str, Any]]) -> str:
-    prompt = _build_prompt(items)
-    data = _call_openai_for_json(prompt)
+def _chunks(items: List[Dict[str, Any]], size: int) -> List[List[Dict[str, Any]]]:
+    if size <= 0 or len(items) <= size:
+        return [items]
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Um único pool por processo (mesmo esquema do gmail_client)
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=OPENAI_CONCURRENCY, thread_name_prefix="openai")
+    return _executor
+
+
+def _merge_results(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Junta as respostas de cada chunk bucket a bucket, reordenando por score.
+    """
+    merged: Dict[str, Any] = {}
+    for bucket in ("alta", "media", "baixa"):
+        rows = [it for data in results for it in _normalize_list(data.get(bucket))]
+        rows.sort(key=_score_of, reverse=True)
+        merged[bucket] = rows
+    return merged
+
+
+def _score_of(it: Dict[str, Any]) -> int:
+    try:
+        return int(it.get("score") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _classify_chunks(chunks: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    prompts = [_build_prompt(chunk) for chunk in chunks]
+    if USE_BATCH:
+        return _request_openai_batch(prompts)
+    if len(prompts) == 1:
+        return [_call_openai_for_json(prompts[0])]
+    # Chunks em paralelo: a latência fica ~1 chamada em vez de N
+    return list(_get_executor().map(_call_openai_for_json, prompts))
+
+
+def _cls_key(it: Dict[str, Any]) -> str:
+    # Conteúdo + modelo + versão do prompt: trocar qualquer um re-classifica o email
+    raw = f"{MODEL}|{PROMPT_VERSION}|".encode("utf-8") + _dedupe_key(it)
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _cached_cls(records: Dict[str, Any], it: Dict[str, Any]):
+    # Só vale se todas as cópias do item já foram classificadas com este conteúdo/modelo/prompt
+    key = _cls_key(it)
+    cls = [(records.get(i) or {}).get("cls") for i in it["ids"]]
+    if not cls or not all(c and c.get("key") == key for c in cls):
+        return None
+    if cls[0].get("bucket") not in ("alta", "media", "baixa"):
+        return None  # registro antigo de item omitido pelo modelo: re-classifica
+    return cls[0]
+
+
+def _remember_cls(records: Dict[str, Any], chunk: List[Dict[str, Any]], data: Dict[str, Any]) -> None:
+    """
+    Guarda no state a classificação de cada email (via "n" da resposta).
+    Item que o modelo omitiu (resposta truncada/parcial) não é gravado: vai de
+    novo ao LLM na próxima execução.
+    """
+    by_n: Dict[int, Any] = {}
+    for bucket in ("alta", "media", "baixa"):
+        for row in _normalize_list(data.get(bucket)):
+            if isinstance(row.get("n"), int):
+                by_n.setdefault(row["n"], (bucket, row))
+
+    for n, it in enumerate(chunk, start=1):
+        if n not in by_n:
+            continue
+        bucket, row = by_n[n]
+        cls = {"key": _cls_key(it), "bucket": bucket, "row": row}
+        for msg_id in it["ids"]:
+            if msg_id in records:
+                records[msg_id]["cls"] = cls
+
+
+def build_summary_from_items(
+    items: List[Dict[str, Any]], state: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    Se `state` for passado (o mesmo do gmail_client), emails já classificados
+    em execuções anteriores saem de state["items"][id]["cls"]; só os novos vão
+    para o LLM. Emails que o pré-filtro local marca como BAIXA também não vão.
+    """
+    records = state.get("items") if state is not None else None
+    if not isinstance(records, dict):
+        records = None
+
+    cached = {"alta": [], "media": [], "baixa": []}
+    pending = items
+    if records is not None:
+        pending = []
+        for it in items:
+            cls = _cached_cls(records, it)
+            if cls is None:
+                pending.append(it)
+            elif cls.get("bucket") in cached:
+                cached[cls["bucket"]].append(cls["row"])
+
+    # O que o pré-filtro local já sabe que é BAIXA não vai para o LLM
+    if LOCAL_LOW_SCORE > 0:
+        to_llm = []
+        for it in pending:
+            row = _local_low_row(it)
+            if row is not None:
+                cached["baixa"].append(row)
+            else:
+                to_llm.append(it)
+        pending = to_llm
+
+    chunks = _chunks(pending, CHUNK_SIZE) if pending else []
+    results = []
+    if chunks:
+        # Sem chave não há como chamar o LLM: falha antes de montar o prompt
+        # (se tudo veio do cache/pré-filtro, a chave nem é necessária)
+        if not os.environ.get("OPENAI_API_KEY"):
+            raise RuntimeError("Missing env var OPENAI_API_KEY.")
+        results = _classify_chunks(chunks)
+
+    if records is not None:
+        for chunk, data in zip(chunks, results):
+            _remember_cls(records, chunk, data)
+    if any(cached.values()):
+        results.append(cached)
+
+    data = results[0] if len(results) == 1 else _merge_results(results)
     return _format_message(data)
 
 
@@ -1,5 +1,10 @@
 import os
-import requests
+
+from http_session import make_session
+
+# Uma sessão por processo: o keep-alive evita novo handshake TCP+TLS a cada envio
+_SESSION = make_session()
+
 
 def send_telegram_message(text: str) -> None:
     token = os.environ["TELEGRAM_BOT_TOKEN"]
@@ -12,5 +17,5 @@ def send_telegram_message(text: str) -> None:
         "disable_web_page_preview": True,
     }
 
-    r = requests.post(url, json=payload, timeout=30)
+    r = _SESSION.post(url, json=payload, timeout=30)
     r.raise_for_status()
@@ -1,6 +1,6 @@
 from gmail_client import list_recent_emails
 
-emails = list_recent_emails(hours_back=24, max_results=5)
+emails = list_recent_emails(max_results=5)
 print(f"Encontrei {len(emails)} emails.\n")
 
 for e in emails:
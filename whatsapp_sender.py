@@ -0,0 +1,57 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from http_session import make_session
+
+# WhatsApp Cloud API (Meta): um POST HTTPS por mensagem, sem navegador/WhatsApp Web.
+GRAPH_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v19.0")
+
+# Mesma política de retry do telegram_sender (ver http_session)
+_SESSION = make_session()
+
+
+_executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Um worker só: os envios saem em ordem, um de cada vez
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whatsapp-send")
+    return _executor
+
+
+def send_whatsapp_message(
+    phone_e164: str, message: str, async_send: bool = False
+) -> Optional[Future]:
+    """
+    Envia `message` para `phone_e164`. Com async_send=True o envio vai para
+    uma thread de fundo e a função devolve o Future na hora (erros aparecem
+    em future.result()).
+    """
+    if async_send:
+        return _get_executor().submit(_send, phone_e164, message)
+    _send(phone_e164, message)
+    return None
+
+
+def _send(phone_e164: str, message: str) -> None:
+    token = os.environ["WHATSAPP_TOKEN"]
+    phone_number_id = os.environ["WHATSAPP_PHONE_NUMBER_ID"]
+
+    url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{phone_number_id}/messages"
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": phone_e164.lstrip("+"),
+        "type": "text",
+        "text": {"body": message, "preview_url": False},
+    }
+
+    r = _SESSION.post(
+        url,
+        json=payload,
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=10,
+    )
+    r.raise_for_status()